@@ -13,47 +13,97 @@ from __future__ import annotations
 import csv
 import os
 import re
-import sys
 from dataclasses import dataclass
-from datetime import date
-from typing import Optional, Iterable
-
+from datetime import date, datetime
+from functools import lru_cache
+from io import BytesIO
+from itertools import chain
+from operator import itemgetter
+from types import ModuleType
+from typing import TYPE_CHECKING, Optional, Iterable, Iterator, Union
+
+import ijson
+import lxml.html
 import requests
-from bs4 import BeautifulSoup, Tag
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-try:
-    from dateutil import parser as dateparser
-except ImportError:
-    print("Please install python-dateutil: pip install python-dateutil", file=sys.stderr)
-    raise
+if TYPE_CHECKING:
+    from bs4 import Tag
 
 
 LIQUIPEDIA_API = "https://liquipedia.net/starcraft2/api.php"
 PAGE = "Patches"
 
-# Matches version strings like "4.1.3", "10.0.0.1", "4.0.2 BU"
-VERSION_PATTERN = re.compile(r"^(\d+(?:\.\d+){1,3})(?: BU)?$")
+# On-disk HTTP cache; stale entries are revalidated with ETag/Last-Modified
+CACHE_PATH = os.path.join(os.path.dirname(__file__), ".liquipedia_cache")
+
+# Matches version strings like "4.1.3", "10.0.0.1", "4.0.2 BU", optionally
+# prefixed with "Patch "; the "version" group holds the bare version
+VERSION_PATTERN = re.compile(
+    r"^(?:(?i:patch)\s+)?(?P<version>\d+(?:\.\d+){1,3}(?: BU)?)$"
+)
+
+# Exact formats tried before falling back to dateutil's fuzzy parser.
+# Liquipedia release dates are almost always "9 January 2018" or ISO.
+_DATE_FORMATS = ("%Y-%m-%d", "%d %B %Y", "%B %d, %Y", "%b %d, %Y")
+
+# dateutil's parser, imported on first use since the fallback is rarely hit
+_dateparser: Optional[ModuleType] = None
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class PatchRow:
     patch_id: str
     build: Optional[str]
     release_date_na: Optional[date]
 
 
-def _session() -> requests.Session:
-    """Create a session with appropriate headers for Liquipedia."""
-    sess = requests.Session()
+def _build_session() -> requests.Session:
+    """Create a cached, retrying session with appropriate headers for Liquipedia."""
+    # Imported here so importing this module neither loads requests_cache
+    # nor creates the cache database
+    import requests_cache
+
+    sess = requests_cache.CachedSession(
+        CACHE_PATH,
+        backend="sqlite",
+        expire_after=3600,
+        cache_control=True,
+    )
     sess.headers.update({
         "User-Agent": "sc2-patch-scraper/1.0 (contact: you@example.com) requests",
         "Accept-Language": "en-US,en;q=0.9",
     })
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+        ),
+    )
+    sess.mount("https://", adapter)
     return sess
 
 
-def fetch_portal_html(sess: requests.Session) -> str:
-    """Fetch rendered HTML for the Portal:Patches page via MediaWiki API."""
+@lru_cache(maxsize=None)
+def _get_session() -> requests.Session:
+    """Return the shared session, building it on first use."""
+    return _build_session()
+
+
+def fetch_portal_html(sess: Optional[requests.Session] = None) -> str:
+    """
+    Fetch rendered HTML for the Portal:Patches page via MediaWiki API.
+
+    Uses the shared session unless one is given, so repeated fetches reuse
+    pooled keep-alive connections.
+    """
+    if sess is None:
+        sess = _get_session()
     params = {
         "action": "parse",
         "format": "json",
@@ -63,31 +113,55 @@ def fetch_portal_html(sess: requests.Session) -> str:
         "disableeditsection": "1",
         "redirects": "1",
     }
-    resp = sess.get(LIQUIPEDIA_API, params=params, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    if "error" in data:
-        raise RuntimeError(f"MediaWiki API error: {data['error']}")
-    return data["parse"]["text"]["*"]
+    resp = sess.get(LIQUIPEDIA_API, params=params, timeout=30, stream=True)
+    with resp:
+        resp.raise_for_status()
+        # Stream the JSON body instead of building the whole response dict.
+        # Cached bodies are already in memory, and their raw stream treats
+        # ijson's read(0) probe as EOF, so read those from the content.
+        if getattr(resp, "from_cache", False):
+            body = BytesIO(resp.content)
+        else:
+            resp.raw.decode_content = True
+            body = resp.raw
+        for key, value in ijson.kvitems(body, ""):
+            if key == "error":
+                raise RuntimeError(f"MediaWiki API error: {value}")
+            if key == "parse":
+                return value["text"]["*"]
+    raise RuntimeError("MediaWiki API response has no parse.text field")
 
 
 def _clean_text(text: str) -> str:
     """Normalize whitespace in text."""
-    return re.sub(r"\s+", " ", text).strip()
+    return " ".join(text.split())
 
 
+@lru_cache(maxsize=4096)
 def _parse_date_maybe(text: str) -> Optional[date]:
     """Parse a date string, returning None for invalid/empty/placeholder values."""
     text = _clean_text(text)
-    if not text or text.lower() in {"-", "n/a", "na", "unknown"}:
+    # Every date has a digit; this also rejects placeholders like "-", "n/a"
+    if not any(ch.isdigit() for ch in text):
         return None
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+
+    global _dateparser
+    if _dateparser is None:
+        from dateutil import parser as dateutil_parser
+        _dateparser = dateutil_parser
     try:
-        parsed = dateparser.parse(text, fuzzy=True)
+        parsed = _dateparser.parse(text, fuzzy=True)
         return parsed.date() if parsed else None
     except Exception:
         return None
 
 
+@lru_cache(maxsize=4096)
 def _extract_version(text: str) -> Optional[str]:
     """
     Extract version string from patch cell text.
@@ -99,40 +173,65 @@ def _extract_version(text: str) -> Optional[str]:
 
     Returns None if no valid version found.
     """
-    text = _clean_text(text)
+    m = VERSION_PATTERN.match(_clean_text(text))
+    return m.group("version") if m else None
+
+
+# Text nodes of a cell, skipping inline <style>/<script> (e.g. TemplateStyles)
+_CELL_TEXT_XPATH = etree.XPath(".//text()[not(ancestor::style or ancestor::script)]")
+
 
-    # Strip "Patch " prefix if present
-    if text.lower().startswith("patch "):
-        text = text[6:].strip()
+def _cell_text(cell: etree._Element) -> str:
+    """Return the whitespace-normalized text content of a table cell."""
+    return _clean_text(" ".join(_CELL_TEXT_XPATH(cell)))
 
-    # Check if it matches version pattern
-    if VERSION_PATTERN.match(text):
-        return text
 
-    return None
+def _is_wikitable(table: etree._Element) -> bool:
+    """Return True if "wikitable" is one of the table's class tokens."""
+    return "wikitable" in (table.get("class") or "").split()
 
 
-def extract_rows_from_table(table: Tag) -> list[PatchRow]:
+def _as_lxml(node: Union[etree._Element, Tag]) -> etree._Element:
+    """Return node as an lxml element, re-parsing BeautifulSoup nodes."""
+    if isinstance(node, etree._Element):
+        return node
+    try:
+        return lxml.html.fromstring(str(node))
+    except etree.ParserError:
+        # Blank or comment-only markup has no elements; treat it as empty
+        return lxml.html.Element("div")
+
+
+def extract_rows_from_table(table: Union[etree._Element, Tag]) -> list[PatchRow]:
     """
     Extract patch data from a single table.
 
     Liquipedia tables have header rows followed by data rows:
     - Header: ['Notes', 'Release date (NA)', 'Build', 'Highlights']
     - Data: Patch name, Date, Build number, Highlights
+
+    Accepts an lxml element or, for compatibility, a BeautifulSoup Tag.
     """
+    table = _as_lxml(table)
     rows: list[PatchRow] = []
 
-    for tr in table.find_all("tr"):
-        cells = tr.find_all(["td", "th"])
+    # Only this table's own rows (directly or via tbody/thead/tfoot), so
+    # tables nested inside cells are not descended into
+    for tr in table.xpath("./tr|./*/tr"):
+        cells = tr.xpath("./td|./th")
         if not cells:
             continue
 
         # Skip header rows (first cell is <th>)
-        if cells[0].name == "th":
+        if cells[0].tag == "th":
             continue
 
         # Column 0: Patch version
-        patch_text = _clean_text(cells[0].get_text(" "))
+        patch_text = _cell_text(cells[0])
+        # Versions start with a digit or "Patch"; skip other rows before the regex
+        first = patch_text[:1]
+        if not first or not (first.isdigit() or first in "Pp"):
+            continue
         version = _extract_version(patch_text)
         if not version:
             continue
@@ -140,13 +239,13 @@ def extract_rows_from_table(table: Tag) -> list[PatchRow]:
         # Column 1: Date
         release_date = None
         if len(cells) > 1:
-            date_text = _clean_text(cells[1].get_text(" "))
+            date_text = _cell_text(cells[1])
             release_date = _parse_date_maybe(date_text)
 
         # Column 2: Build
         build = None
         if len(cells) > 2:
-            build_text = _clean_text(cells[2].get_text(" "))
+            build_text = _cell_text(cells[2])
             if build_text and build_text != "-":
                 build = build_text
 
@@ -159,41 +258,81 @@ def extract_rows_from_table(table: Tag) -> list[PatchRow]:
     return rows
 
 
-def extract_all_rows(soup: BeautifulSoup) -> list[PatchRow]:
+def iter_all_rows(doc: Union[etree._Element, Tag]) -> Iterator[PatchRow]:
+    """Yield patch rows from all wikitables in the page, in document order."""
+    doc = _as_lxml(doc)
+    # Scoped to doc itself and its descendants, not the whole document
+    for table in doc.xpath("descendant-or-self::table"):
+        if _is_wikitable(table):
+            yield from extract_rows_from_table(table)
+
+
+def extract_all_rows(doc: Union[etree._Element, Tag]) -> list[PatchRow]:
     """Extract patch rows from all wikitables in the page."""
-    all_rows: list[PatchRow] = []
+    return list(iter_all_rows(doc))
 
-    for table in soup.find_all("table", class_="wikitable"):
-        all_rows.extend(extract_rows_from_table(table))
 
-    return all_rows
+def iter_rows_from_html(html: str) -> Iterator[PatchRow]:
+    """
+    Stream patch rows from all wikitables in a page's HTML.
 
+    Tables are parsed incrementally and wikitables are cleared once read.
+    Blank input yields no rows.
 
-def write_csv(rows: Iterable[PatchRow], path: str) -> None:
-    """Write patch rows to a CSV file, sorted by release date."""
-    sorted_rows = sorted(
-        rows,
-        key=lambda r: (r.release_date_na or date.min, r.patch_id)
+    Tables are handled at their closing tag, so a wikitable nested inside
+    another is yielded before the table enclosing it. This differs from
+    iter_all_rows' document order; write_csv sorts, so the CSV is the same.
+    """
+    # iterparse raises XMLSyntaxError on an empty byte stream
+    if not html.strip():
+        return
+    context = etree.iterparse(
+        BytesIO(html.encode("utf-8")),
+        events=("end",),
+        tag="table",
+        html=True,
+        encoding="utf-8",
     )
+    for _, table in context:
+        if _is_wikitable(table):
+            yield from extract_rows_from_table(table)
+            table.clear()
+
+
+def write_csv(rows: Iterable[PatchRow], path: str) -> int:
+    """
+    Write patch rows to a CSV file, sorted by release date.
 
-    with open(path, "w", newline="", encoding="utf-8") as f:
+    rows may be a generator; it is consumed once. Returns the number of
+    rows written.
+    """
+    # Decorate once with precomputed keys; undated rows sort first
+    sentinel = date.min
+    keyed = [((r.release_date_na or sentinel, r.patch_id), r) for r in rows]
+    keyed.sort(key=itemgetter(0))
+
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
         writer = csv.writer(f)
         writer.writerow(["patch_id", "build", "release_date_na"])
-        for row in sorted_rows:
-            writer.writerow([
+        writer.writerows(
+            (
                 row.patch_id,
                 row.build or "",
                 row.release_date_na.isoformat() if row.release_date_na else "",
-            ])
+            )
+            for _, row in keyed
+        )
+
+    return len(keyed)
 
 
 def main() -> None:
-    sess = _session()
-    html = fetch_portal_html(sess)
-    soup = BeautifulSoup(html, "html.parser")
-    rows = extract_all_rows(soup)
+    html = fetch_portal_html()
+    rows = iter_rows_from_html(html)
 
-    if not rows:
+    # Peek so an empty extraction fails before any existing CSV is overwritten
+    first = next(rows, None)
+    if first is None:
         raise RuntimeError(
             "Extracted 0 patch rows. Liquipedia table format may have changed."
         )
@@ -202,8 +341,8 @@ def main() -> None:
     os.makedirs(out_dir, exist_ok=True)
     out_path = os.path.join(out_dir, "patch_timeline.csv")
 
-    write_csv(rows, out_path)
-    print(f"Wrote {len(rows)} rows to {out_path}")
+    count = write_csv(chain([first], rows), out_path)
+    print(f"Wrote {count} rows to {out_path}")
 
 
 if __name__ == "__main__":
@@ -2,13 +2,22 @@
 """Tests for scrape_patches.py"""
 
 import csv
+import gzip
+import json
 import os
+import subprocess
+import sys
 import tempfile
 from datetime import date
+from io import BytesIO
 
+import lxml.html
 import pytest
+import requests
+import urllib3
 from bs4 import BeautifulSoup
 
+import scrape_patches
 from scrape_patches import (
     PatchRow,
     _clean_text,
@@ -16,10 +25,109 @@ from scrape_patches import (
     _extract_version,
     extract_rows_from_table,
     extract_all_rows,
+    fetch_portal_html,
+    iter_all_rows,
+    iter_rows_from_html,
     write_csv,
 )
 
 
+# =============================================================================
+# Test: fetch_portal_html
+# =============================================================================
+
+class _StubSession:
+    """Session stand-in whose get() returns a canned JSON response."""
+
+    def __init__(self, payload, gzipped=False, from_cache=False):
+        self.payload = payload
+        self.gzipped = gzipped
+        self.from_cache = from_cache
+
+    def get(self, url, **kwargs):
+        body = json.dumps(self.payload).encode("utf-8")
+        resp = requests.Response()
+        resp.status_code = 200
+        if self.from_cache:
+            # Cached bodies are read from content, never from the raw stream
+            resp._content = body
+            resp.from_cache = True  # type: ignore[attr-defined]
+            return resp
+        headers = {}
+        if self.gzipped:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        resp.raw = urllib3.HTTPResponse(
+            body=BytesIO(body),
+            headers=headers,
+            preload_content=False,
+            decode_content=False,
+        )
+        return resp
+
+
+PARSE_PAYLOAD = {"parse": {"title": "Patches", "text": {"*": "<p>Patches</p>"}}}
+
+
+def test_fetch_portal_html_returns_parse_text():
+    assert fetch_portal_html(_StubSession(PARSE_PAYLOAD)) == "<p>Patches</p>"
+
+
+def test_fetch_portal_html_decodes_gzip_body():
+    sess = _StubSession(PARSE_PAYLOAD, gzipped=True)
+    assert fetch_portal_html(sess) == "<p>Patches</p>"
+
+
+def test_fetch_portal_html_reads_cached_response_from_content():
+    sess = _StubSession(PARSE_PAYLOAD, from_cache=True)
+    assert fetch_portal_html(sess) == "<p>Patches</p>"
+
+
+def test_fetch_portal_html_raises_on_api_error():
+    sess = _StubSession({"error": {"code": "missingtitle"}})
+    with pytest.raises(RuntimeError, match="MediaWiki API error"):
+        fetch_portal_html(sess)
+
+
+def test_fetch_portal_html_raises_without_parse_field():
+    sess = _StubSession({"batchcomplete": ""})
+    with pytest.raises(RuntimeError, match="no parse.text"):
+        fetch_portal_html(sess)
+
+
+# =============================================================================
+# Test: module import
+# =============================================================================
+
+def test_import_does_not_create_http_cache(tmp_path):
+    # Fresh interpreter in an empty directory: nothing cached is loaded or written
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    code = (
+        "import sys, scrape_patches; "
+        "print('requests_cache' in sys.modules, 'dateutil' in sys.modules)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": module_dir},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.split() == ["False", "False"]
+    assert list(tmp_path.iterdir()) == []
+
+
+# =============================================================================
+# Test: PatchRow
+# =============================================================================
+
+def test_patch_row_has_no_instance_dict():
+    row = PatchRow(patch_id="4.1.3", build="61021", release_date_na=date(2018, 1, 9))
+    assert not hasattr(row, "__dict__")
+
+
 # =============================================================================
 # Test: _clean_text
 # =============================================================================
@@ -36,6 +144,10 @@ def test_clean_text_handles_tabs():
     assert _clean_text("hello\t\tworld") == "hello world"
 
 
+def test_clean_text_handles_non_breaking_spaces():
+    assert _clean_text("Patch\xa04.1.3\xa0") == "Patch 4.1.3"
+
+
 # =============================================================================
 # Test: _parse_date_maybe
 # =============================================================================
@@ -56,6 +168,11 @@ def test_parse_date_liquipedia_format():
     assert _parse_date_maybe("9 January 2018") == date(2018, 1, 9)
 
 
+def test_parse_date_falls_back_to_fuzzy_parser():
+    # Not one of the exact formats; handled by dateutil's fuzzy parsing
+    assert _parse_date_maybe("9 January 2018 (hotfix)") == date(2018, 1, 9)
+
+
 def test_parse_date_returns_none_for_dash():
     assert _parse_date_maybe("-") is None
 
@@ -254,6 +371,57 @@ def test_extract_rows_handles_missing_columns():
     assert rows[0].release_date_na == date(2018, 1, 9)
 
 
+def test_extract_rows_ignores_nested_table_rows():
+    html = """
+    <table class="wikitable">
+        <tbody>
+            <tr>
+                <td>Patch 4.1.3</td>
+                <td>9 January 2018</td>
+                <td>61021</td>
+                <td>
+                    <table>
+                        <tr><td>Patch 9.9.9</td><td>1 January 2030</td></tr>
+                    </table>
+                </td>
+            </tr>
+        </tbody>
+    </table>
+    """
+    table = lxml.html.fromstring(html)
+    rows = extract_rows_from_table(table)
+
+    assert [r.patch_id for r in rows] == ["4.1.3"]
+
+
+def test_extract_rows_ignores_style_and_script_text():
+    html = """
+    <table class="wikitable">
+        <tr>
+            <td>Patch 4.1.3<script>var x = 1;</script></td>
+            <td><style>.date{}</style>9 January 2018</td>
+            <td>61021<style>.a{}</style></td>
+        </tr>
+    </table>
+    """
+    for table in (lxml.html.fromstring(html), BeautifulSoup(html, "html.parser").table):
+        rows = extract_rows_from_table(table)
+
+        assert rows == [
+            PatchRow(patch_id="4.1.3", build="61021", release_date_na=date(2018, 1, 9))
+        ]
+
+
+def test_extract_rows_from_lxml_element():
+    table = lxml.html.fromstring(TABLE_WITH_HEADER_HTML)
+    rows = extract_rows_from_table(table)
+
+    assert len(rows) == 2
+    assert rows[0].patch_id == "5.0.15"
+    assert rows[0].build == "95248"
+    assert rows[0].release_date_na == date(2025, 9, 30)
+
+
 # =============================================================================
 # Test: extract_all_rows (multiple tables)
 # =============================================================================
@@ -290,12 +458,80 @@ def test_extract_all_rows_combines_tables():
     assert "3.19.1" in versions
 
 
+def test_extract_all_rows_from_lxml_document():
+    doc = lxml.html.fromstring(MULTI_TABLE_HTML)
+    rows = extract_all_rows(doc)
+
+    assert [r.patch_id for r in rows] == ["4.1.3", "3.19.1"]
+
+
+def test_iter_all_rows_is_lazy_and_ordered(monkeypatch):
+    calls = []
+    original = scrape_patches.extract_rows_from_table
+
+    def counting_extract(table):
+        calls.append(table)
+        return original(table)
+
+    monkeypatch.setattr(scrape_patches, "extract_rows_from_table", counting_extract)
+    doc = lxml.html.fromstring(MULTI_TABLE_HTML)
+    rows = iter_all_rows(doc)
+
+    # No table is processed until the first row is requested
+    assert calls == []
+    assert next(rows).patch_id == "4.1.3"
+    assert len(calls) == 1
+    assert [r.patch_id for r in rows] == ["3.19.1"]
+    assert len(calls) == 2
+
+
+def test_extract_all_rows_scoped_to_lxml_subtree():
+    html = """
+    <div>
+        <table class="wikitable"><tr><td>Patch 1.0.0</td></tr></table>
+        <div id="cur">
+            <table class="wikitable"><tr><td>Patch 4.1.3</td></tr></table>
+        </div>
+        <table class="wikitable"><tr><td>Patch 9.9.9</td></tr></table>
+    </div>
+    """
+    subtree = lxml.html.fromstring(html).get_element_by_id("cur")
+    rows = extract_all_rows(subtree)
+
+    assert [r.patch_id for r in rows] == ["4.1.3"]
+
+
+def test_extract_all_rows_matches_whole_class_token():
+    html = """
+    <div>
+        <table class="nowikitable-x"><tr><td>Patch 9.9.9</td></tr></table>
+        <table class="sortable wikitable"><tr><td>Patch 4.1.3</td></tr></table>
+    </div>
+    """
+    rows = extract_all_rows(lxml.html.fromstring(html))
+
+    assert [r.patch_id for r in rows] == ["4.1.3"]
+
+
+def test_extract_all_rows_accepts_lone_table():
+    table = lxml.html.fromstring(HEADERLESS_TABLE_HTML)
+    rows = extract_all_rows(table)
+
+    assert [r.patch_id for r in rows] == ["4.1.3", "4.1.2"]
+
+
 def test_extract_all_rows_empty_when_no_tables():
     soup = BeautifulSoup("<div>No tables</div>", "html.parser")
     rows = extract_all_rows(soup)
     assert len(rows) == 0
 
 
+@pytest.mark.parametrize("html", ["", "   ", "<!-- no content -->"])
+def test_extract_all_rows_empty_for_blank_soup(html):
+    soup = BeautifulSoup(html, "html.parser")
+    assert extract_all_rows(soup) == []
+
+
 # =============================================================================
 # Test: write_csv
 # =============================================================================
@@ -349,6 +585,28 @@ def test_write_csv_sorts_by_date():
         os.unlink(path)
 
 
+def test_write_csv_accepts_generator_and_returns_count():
+    rows = (
+        PatchRow(patch_id=f"5.0.{i}", build=None, release_date_na=date(2022, 1, i))
+        for i in (3, 1, 2)
+    )
+
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".csv", delete=False) as f:
+        path = f.name
+
+    try:
+        assert write_csv(rows, path) == 3
+
+        with open(path, "r") as f:
+            reader = csv.reader(f)
+            next(reader)  # skip header
+            data = list(reader)
+
+        assert [row[0] for row in data] == ["5.0.1", "5.0.2", "5.0.3"]
+    finally:
+        os.unlink(path)
+
+
 def test_write_csv_handles_none_values():
     rows = [
         PatchRow(patch_id="5.0.11", build=None, release_date_na=None),
@@ -457,6 +715,78 @@ def test_integration_liquipedia_structure():
     assert row_bu.release_date_na == date(2017, 11, 28)
 
 
+def test_integration_liquipedia_structure_lxml_parser():
+    soup = BeautifulSoup(REALISTIC_LIQUIPEDIA_HTML, "lxml")
+    rows = extract_all_rows(soup)
+
+    assert len(rows) == 4
+    assert [r.patch_id for r in rows] == ["5.0.15", "5.0.14", "4.0.2 BU", "4.0.2"]
+
+    row_bu = next(r for r in rows if r.patch_id == "4.0.2 BU")
+    assert row_bu.build == "59877"
+    assert row_bu.release_date_na == date(2017, 11, 28)
+
+
+def test_iter_rows_from_html_matches_extract_all_rows():
+    streamed = list(iter_rows_from_html(REALISTIC_LIQUIPEDIA_HTML))
+    doc = lxml.html.fromstring(REALISTIC_LIQUIPEDIA_HTML)
+
+    assert streamed == extract_all_rows(doc)
+
+
+NESTED_WIKITABLE_HTML = """
+<div>
+    <table class="wikitable">
+        <tr>
+            <td>Patch 4.1.3</td>
+            <td>9 January 2018</td>
+            <td>61021</td>
+            <td>
+                <table class="wikitable">
+                    <tr><td>Patch 3.0.0</td><td>1 June 2016</td><td>1</td></tr>
+                </table>
+            </td>
+        </tr>
+        <tr><td>Patch 4.1.2</td><td>19 December 2017</td><td>60604</td></tr>
+    </table>
+</div>
+"""
+
+
+def test_iter_rows_from_html_yields_nested_wikitable_first():
+    streamed = [r.patch_id for r in iter_rows_from_html(NESTED_WIKITABLE_HTML)]
+    doc = lxml.html.fromstring(NESTED_WIKITABLE_HTML)
+    in_document_order = [r.patch_id for r in extract_all_rows(doc)]
+
+    # Same rows; streaming handles the inner table at its closing tag first
+    assert in_document_order == ["4.1.3", "4.1.2", "3.0.0"]
+    assert streamed == ["3.0.0", "4.1.3", "4.1.2"]
+
+
+def test_iter_rows_from_html_skips_non_wikitables():
+    html = """
+    <div>
+        <table class="infobox">
+            <tr><td>Patch 9.9.9</td><td>1 January 2030</td><td>1</td></tr>
+        </table>
+        <table class="nowikitable-x">
+            <tr><td>Patch 8.8.8</td><td>1 January 2029</td><td>2</td></tr>
+        </table>
+        <table class="wikitable sortable">
+            <tr><td>Patch 4.1.3</td><td>9 January 2018</td><td>61021</td></tr>
+        </table>
+    </div>
+    """
+    rows = list(iter_rows_from_html(html))
+
+    assert [r.patch_id for r in rows] == ["4.1.3"]
+
+
+@pytest.mark.parametrize("html", ["", "   \n"])
+def test_iter_rows_from_html_blank_input_yields_nothing(html):
+    assert list(iter_rows_from_html(html)) == []
+
+
 def test_integration_full_pipeline():
     soup = BeautifulSoup(REALISTIC_LIQUIPEDIA_HTML, "html.parser")
     rows = extract_all_rows(soup)